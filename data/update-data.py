@@ -9,147 +9,257 @@
 #
 
 import os
-import json
+import re
+import argparse
+import stat
 import requests
 import subprocess
 import yaml
-from datetime import date
-from tempfile import TemporaryDirectory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, datetime, timedelta, timezone
+from email.utils import format_datetime
+from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# use the faster orjson parser if it is available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# prefer the libyaml-based loader, if PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlSafeLoader
+except ImportError:
+    from yaml import SafeLoader as YamlSafeLoader
 
 
 IANA_TLD_LIST_URL = 'https://data.iana.org/TLD/tlds-alpha-by-domain.txt'
 SPDX_REPO_URL = 'https://github.com/spdx/license-list-data.git'
+SPDX_RAW_URL = 'https://raw.githubusercontent.com/spdx/license-list-data/{tag}/{path}'
 MENU_SPEC_URL = 'https://gitlab.freedesktop.org/xdg/xdg-specs/raw/master/menu/menu-spec.xml'
 
+HTTP_TIMEOUT = 30
+
+# os.umask() can only be queried by setting it, so do that once while we are
+# still single-threaded
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+# Lines of the IANA list that we accept as TLDs. This skips comments, as well as
+# internationalized names (we don't support them for AppStream IDs) and the very
+# long names (usually brands).
+# FIXME: Do we really want to impose the length restriction just to keep the TLD
+# pool small?
+TLD_LINE_RE = re.compile(rb'\s*(?!#|XN--)(\S{1,4})\s*')
+
+# release tags of the SPDX license data, e.g. "v3.13"
+RELEASE_TAG_RE = re.compile(r'v?\d+(\.\d+)*')
+
+
+def _make_session():
+    ''' Create a HTTP session that keeps connections alive and retries transient failures '''
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(total=3,
+                                            backoff_factor=0.3,
+                                            status_forcelist=(429, 500, 502, 503, 504)))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _write_list_file(fname, header, entries):
+    ''' Atomically write a generated list file, leaving it untouched if its contents did not change '''
+    contents = (header + '\n'.join(entries) + '\n').encode('utf-8')
+    if os.path.exists(fname):
+        with open(fname, 'rb') as f:
+            if f.read() == contents:
+                return
+        mode = stat.S_IMODE(os.stat(fname).st_mode)
+    else:
+        # the temporary file is private, so apply the mode a new file would get
+        mode = 0o666 & ~UMASK
+
+    # write to a temporary file next to the target, so an aborted run never leaves a truncated file
+    with NamedTemporaryFile('wb',
+                            dir=os.path.dirname(fname),
+                            prefix='.{}.'.format(os.path.basename(fname)),
+                            delete=False) as f:
+        try:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+            os.chmod(f.name, mode)
+        except BaseException:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, fname)
+
+
+def _read_header_value(fname, prefix):
+    ''' Get the value following prefix in the comment header of a previously generated file '''
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if prefix in line:
+                return line.split(prefix, 1)[1].strip()
+    return None
 
-def update_tld_list(url, fname):
-    print('Getting TLD list from IANA...')
-
-    data_result = list()
-    r = requests.get(url)
-    raw_data = str(r.content, 'utf-8')
-    for line in raw_data.split('\n'):
-        line = line.strip()
-        if not line:
-            continue
-        if line.startswith('#'):
-            continue
 
-        # filter out internationalized names, we don't support them for AppStream IDs
-        if line.startswith('XN--'):
-            continue
+def _if_modified_since_headers(fname):
+    ''' Get HTTP headers to only download data again if it was modified since we last generated fname '''
+    last_update = _read_header_value(fname, 'Last updated on')
+    if not last_update:
+        return {}
 
-        # we disallow the very long names (usually brands)
-        # FIXME: Do we really want to impose this restriction just to keep the TLD
-        # pool small?
-        if len(line) > 4:
-            continue
+    # we recorded a local date, so allow for a day of slack
+    since = datetime.combine(date.fromisoformat(last_update) - timedelta(days=1),
+                             datetime.min.time(), tzinfo=timezone.utc)
+    return {'If-Modified-Since': format_datetime(since, usegmt=True)}
 
-        data_result.append(line.lower())
 
-    data_result.sort()
-    with open(fname, 'w') as f:
-        f.write('# IANA TLDs we recognize for AppStream IDs.\n')
-        f.write('# Derived from the full list at {}\n'.format(url))
-        f.write('# Last updated on {}\n'.format(date.today().isoformat()))
+def update_tld_list(session, url, fname, force=False):
+    print('Getting TLD list from IANA...')
 
-        f.write('\n'.join(data_result))
-        f.write('\n')
+    headers = {} if force else _if_modified_since_headers(fname)
+    data_result = list()
+    with session.get(url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as r:
+        if r.status_code == 304:
+            print('TLD list is already up to date.')
+            return
+        r.raise_for_status()
+        for line in r.iter_lines():
+            m = TLD_LINE_RE.fullmatch(line)
+            if m:
+                data_result.append(str(m.group(1).lower(), 'ascii'))
 
+    data_result.sort()
+    _write_list_file(fname,
+                     '# IANA TLDs we recognize for AppStream IDs.\n'
+                     '# Derived from the full list at {}\n'
+                     '# Last updated on {}\n'.format(url, date.today().isoformat()),
+                     data_result)
 
-def _read_spdx_licenses(data_dir, last_tag_ver, only_free=False):
-    # load license and exception data
-    licenses_json_fname = os.path.join(data_dir, 'json', 'licenses.json')
-    exceptions_json_fname = os.path.join(data_dir, 'json', 'exceptions.json')
-    with open(licenses_json_fname, 'r') as f:
-        licenses_data = json.loads(f.read())
-    with open(exceptions_json_fname, 'r') as f:
-        exceptions_data = json.loads(f.read())
 
+def _read_spdx_licenses(licenses_data, exceptions_data, last_tag_ver):
     # get version of the data we are currently retrieving
     license_ver_ref = licenses_data.get('licenseListVersion')
     if not license_ver_ref:
         license_ver_ref = last_tag_ver
     exceptions_ver_ref = exceptions_data.get('licenseListVersion')
-    if not license_ver_ref:
+    if not exceptions_ver_ref:
         exceptions_ver_ref = last_tag_ver
 
+    # sort once, so both the full and the free list are ordered
+    licenses = sorted(licenses_data['licenses'], key=lambda license: license['licenseId'])
     lid_list = []
-    for license in licenses_data['licenses']:
-        if only_free:
-            if not license.get('isFsfLibre') and not license.get('isOsiApproved'):
-                continue
+    free_lid_list = []
+    for license in licenses:
         lid_list.append(license['licenseId'])
+        if license.get('isFsfLibre') or license.get('isOsiApproved'):
+            free_lid_list.append(license['licenseId'])
 
     eid_list = []
     for exception in exceptions_data['exceptions']:
         eid_list.append(exception['licenseExceptionId'])
+    eid_list.sort()
 
     return {'licenses': lid_list,
+            'free_licenses': free_lid_list,
             'exceptions': eid_list,
             'license_list_ver': license_ver_ref,
             'eceptions_list_ver': exceptions_ver_ref}
 
 
-def update_spdx_id_list(git_url, licenselist_fname, licenselist_free_fname, exceptionlist_fname, with_deprecated=True):
-    print('Updating list of SPDX license IDs...')
-    tdir = TemporaryDirectory(prefix='spdx_master-')
+def _find_latest_release_tag(git_url):
+    ''' Get the name of the highest release version tag of a remote git repository '''
+    tag_refs = subprocess.check_output(['git',
+                                        'ls-remote',
+                                        '--tags',
+                                        '--refs',
+                                        git_url])
+
+    release_tags = []
+    for line in str(tag_refs, 'utf-8').splitlines():
+        # each line has the form "<sha>\trefs/tags/<name>"
+        ref = line.split('\t', 1)[-1].strip()
+        if not ref.startswith('refs/tags/'):
+            continue
+        tag = ref[len('refs/tags/'):]
+        # ignore pre-releases and any other tags that are not plain version numbers
+        if RELEASE_TAG_RE.fullmatch(tag):
+            release_tags.append(tag)
+
+    if not release_tags:
+        raise RuntimeError('Unable to find any release tag in {}'.format(git_url))
+    return max(release_tags, key=lambda tag: [int(part) for part in tag.lstrip('v').split('.')])
+
 
-    subprocess.check_call(['git',
-                           'clone',
-                           git_url, tdir.name])
-    last_tag_ver = subprocess.check_output(['git', 'describe', '--abbrev=0',  '--tags'], cwd=tdir.name)
-    last_tag_ver = str(last_tag_ver.strip(), 'utf-8')
-    if last_tag_ver.startswith('v'):
-        last_tag_ver = last_tag_ver[1:]
+def update_spdx_id_list(session, git_url, licenselist_fname, licenselist_free_fname, exceptionlist_fname,
+                        with_deprecated=True, force=False):
+    print('Updating list of SPDX license IDs...')
 
-    license_data = _read_spdx_licenses(tdir.name, last_tag_ver)
+    # determine the latest release tag, so we can skip the update if we already have its data
+    last_tag = _find_latest_release_tag(git_url)
+    last_tag_ver = last_tag[1:] if last_tag.startswith('v') else last_tag
+    all_current = all(_read_header_value(fname, 'recognized by SPDX, v') == last_tag_ver
+                      for fname in [licenselist_fname, licenselist_free_fname, exceptionlist_fname])
+    if all_current and not force:
+        print('SPDX license IDs are already up to date (v{}).'.format(last_tag_ver))
+        return
+
+    # we only need the JSON data of the latest release, so download just these
+    # files instead of cloning the (very large) repository
+    spdx_data = {}
+    for json_path in ['json/licenses.json', 'json/exceptions.json']:
+        r = session.get(SPDX_RAW_URL.format(tag=last_tag, path=json_path), timeout=HTTP_TIMEOUT)
+        r.raise_for_status()
+        spdx_data[json_path] = json_loads(r.content)
+    licenses_data = spdx_data['json/licenses.json']
+    exceptions_data = spdx_data['json/exceptions.json']
+
+    license_data = _read_spdx_licenses(licenses_data, exceptions_data, last_tag_ver)
     lid_list = license_data['licenses']
     eid_list = license_data['exceptions']
     license_list_ver = license_data['license_list_ver']
 
-    lid_list.sort()
-    with open(licenselist_fname, 'w') as f:
-        f.write('# The list of all licenses recognized by SPDX, v{}\n'.format(license_list_ver))
-        f.write('\n'.join(lid_list))
-        f.write('\n')
+    _write_list_file(licenselist_fname,
+                     '# The list of all licenses recognized by SPDX, v{}\n'.format(license_list_ver),
+                     lid_list)
 
-    eid_list.sort()
-    with open(exceptionlist_fname, 'w') as f:
-        f.write('# The list of license exceptions recognized by SPDX, v{}\n'.format(license_data['eceptions_list_ver']))
-        f.write('\n'.join(eid_list))
-        f.write('\n')
+    _write_list_file(exceptionlist_fname,
+                     '# The list of license exceptions recognized by SPDX, v{}\n'.format(license_data['eceptions_list_ver']),
+                     eid_list)
 
-    license_free_data = _read_spdx_licenses(tdir.name, last_tag_ver, only_free=True)
-    with open(licenselist_free_fname, 'w') as f:
-        f.write('# The list of free (OSI or FSF approved) licenses recognized by SPDX, v{}\n'.format(license_list_ver))
-        f.write('\n'.join(sorted(license_free_data['licenses'])))
-        f.write('\n')
+    _write_list_file(licenselist_free_fname,
+                     '# The list of free (OSI or FSF approved) licenses recognized by SPDX, v{}\n'.format(license_list_ver),
+                     license_data['free_licenses'])
 
 
-def update_platforms_data():
+def update_platforms_data(data_dir):
     print('Updating platform triplet part data...')
 
-    with open('platforms.yml', 'r') as f:
-        data = yaml.safe_load(f)
+    with open(os.path.join(data_dir, 'platforms.yml'), 'rb') as f:
+        data = yaml.load(f, Loader=YamlSafeLoader)
 
     def write_platform_data(fname, values):
-        with open(fname, 'w') as f:
-            f.write('# This file is derived from platforms.yml - DO NOT EDIT IT MANUALLY!\n')
-            f.write('\n'.join(values))
-            f.write('\n')
+        _write_list_file(fname,
+                         '# This file is derived from platforms.yml - DO NOT EDIT IT MANUALLY!\n',
+                         values)
 
-    write_platform_data('platform_arch.txt', data['architectures'])
-    write_platform_data('platform_os.txt', data['os_kernels'])
-    write_platform_data('platform_env.txt', data['os_environments'])
+    write_platform_data(os.path.join(data_dir, 'platform_arch.txt'), data['architectures'])
+    write_platform_data(os.path.join(data_dir, 'platform_os.txt'), data['os_kernels'])
+    write_platform_data(os.path.join(data_dir, 'platform_env.txt'), data['os_environments'])
 
 
-def update_categories_list(spec_url, cat_fname):
+def update_categories_list(session, spec_url, cat_fname, force=False):
     ''' The worst parser ever, extracting category information directoly from the spec Docbook file '''
     from enum import Enum, auto
 
-    req = requests.get(spec_url)
-
     class SpecSection(Enum):
         NONE = auto()
         MAIN_CATS = auto()
@@ -167,91 +277,135 @@ def update_categories_list(spec_url, cat_fname):
 
     current_cat = {}
     spec_sect = SpecSection.NONE
-    for line in str(req.content, 'utf-8').splitlines():
-        if '<entry>Main Category</entry>' in line:
-            spec_sect = SpecSection.MAIN_CATS
-            continue
-
-        if '<entry>Additional Category</entry>' in line:
-            spec_sect = SpecSection.EXTRA_CATS
-            continue
 
-        if '<tbody>' in line:
-            current_cat = {}
-            if spec_sect == SpecSection.MAIN_CATS:
-                spec_sect = SpecSection.MAIN_CATS_BODY
-            else:
-                spec_sect = SpecSection.EXTRA_CATS_BODY
-            continue
+    # the server validates the spec by ETag, so we keep the last one we saw next to
+    # the generated list (and not in it, so the list stays deterministic)
+    etag_fname = cat_fname + '.etag'
+    headers = {}
+    if not force and os.path.exists(cat_fname) and os.path.exists(etag_fname):
+        with open(etag_fname, 'r') as f:
+            etag = f.read().strip()
+        if etag:
+            headers['If-None-Match'] = etag
+
+    # stream the document, we can stop reading once we have all categories
+    with session.get(spec_url, headers=headers, timeout=HTTP_TIMEOUT, stream=True) as req:
+        if req.status_code == 304:
+            print('Category list is already up to date.')
+            return
+        req.raise_for_status()
+        etag = req.headers.get('ETag')
+        req.encoding = 'utf-8'
+        for line in req.iter_lines(decode_unicode=True):
+            if '<entry>Main Category</entry>' in line:
+                spec_sect = SpecSection.MAIN_CATS
+                continue
 
-        if spec_sect == SpecSection.MAIN_CATS_BODY:
-            if '<row>' in line:
-                if current_cat:
-                    main_cats.append(current_cat)
-                    current_cat = {}
+            if '<entry>Additional Category</entry>' in line:
+                spec_sect = SpecSection.EXTRA_CATS
                 continue
-            if '</tbody>' in line:
-                if current_cat:
-                    main_cats.append(current_cat)
-                    current_cat = {}
-                spec_sect = SpecSection.NONE
+
+            if '<tbody>' in line:
+                current_cat = {}
+                if spec_sect == SpecSection.MAIN_CATS:
+                    spec_sect = SpecSection.MAIN_CATS_BODY
+                else:
+                    spec_sect = SpecSection.EXTRA_CATS_BODY
                 continue
 
-            if '<entry>' in line:
-                if current_cat.get('desc'):
+            if spec_sect == SpecSection.MAIN_CATS_BODY:
+                if '<row>' in line:
+                    if current_cat:
+                        main_cats.append(current_cat)
+                        current_cat = {}
+                    continue
+                if '</tbody>' in line:
+                    if current_cat:
+                        main_cats.append(current_cat)
+                        current_cat = {}
+                    spec_sect = SpecSection.NONE
                     continue
-                if current_cat:
-                    current_cat['desc'] = get_entry(line)
-                else:
-                    current_cat['name'] = get_entry(line)
-            continue
 
-        if spec_sect == SpecSection.EXTRA_CATS_BODY:
-            if '<row>' in line:
-                if current_cat:
-                    extra_cats.append(current_cat)
-                    current_cat = {}
+                if '<entry>' in line:
+                    if current_cat.get('desc'):
+                        continue
+                    if current_cat:
+                        current_cat['desc'] = get_entry(line)
+                    else:
+                        current_cat['name'] = get_entry(line)
                 continue
-            if '</tbody>' in line:
-                if current_cat:
-                    main_cats.append(current_cat)
-                    current_cat = {}
-                spec_sect = SpecSection.NONE
-                # nothing interesting follows for us after the additional categories are done
-                break
 
-            if '<entry>' in line:
-                if current_cat.get('rel'):
+            if spec_sect == SpecSection.EXTRA_CATS_BODY:
+                if '<row>' in line:
+                    if current_cat:
+                        extra_cats.append(current_cat)
+                        current_cat = {}
                     continue
-                if current_cat:
-                    if not current_cat.get('desc'):
-                        current_cat['desc'] = get_entry(line)
-                    if not current_cat.get('rel'):
-                        current_cat['rel'] = get_entry(line)
-                else:
-                    current_cat['name'] = get_entry(line)
-            continue
+                if '</tbody>' in line:
+                    if current_cat:
+                        main_cats.append(current_cat)
+                        current_cat = {}
+                    spec_sect = SpecSection.NONE
+                    # nothing interesting follows for us after the additional categories are done
+                    break
+
+                if '<entry>' in line:
+                    if current_cat.get('rel'):
+                        continue
+                    if current_cat:
+                        if not current_cat.get('desc'):
+                            current_cat['desc'] = get_entry(line)
+                        if not current_cat.get('rel'):
+                            current_cat['rel'] = get_entry(line)
+                    else:
+                        current_cat['name'] = get_entry(line)
+                continue
 
     all_cat_names = [cat['name'] for cat in main_cats]
     all_cat_names.extend([cat['name'] for cat in extra_cats])
     all_cat_names.sort()
 
-    with open(cat_fname, 'w') as f:
-        f.write('# Freedesktop Menu Categories\n')
-        f.write('# See https://specifications.freedesktop.org/menu-spec/latest/apa.html\n')
-        f.write('\n'.join(all_cat_names))
-        f.write('\n')
+    _write_list_file(cat_fname,
+                     '# Freedesktop Menu Categories\n'
+                     '# See https://specifications.freedesktop.org/menu-spec/latest/apa.html\n',
+                     all_cat_names)
+    if etag:
+        _write_list_file(etag_fname, '', [etag])
+    elif os.path.exists(etag_fname):
+        os.remove(etag_fname)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Update the static data AppStream uses from upstream sources.')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate all data, even if upstream did not change')
+    options = parser.parse_args()
+
     data_dir = os.path.dirname(os.path.abspath(__file__))
     print('Data directory is: {}'.format(data_dir))
-    os.chdir(data_dir)
 
-    update_tld_list(IANA_TLD_LIST_URL, 'iana-filtered-tld-list.txt')
-    update_spdx_id_list(SPDX_REPO_URL, 'spdx-license-ids.txt', 'spdx-free-license-ids.txt', 'spdx-license-exception-ids.txt')
-    update_categories_list(MENU_SPEC_URL, 'xdg-category-names.txt')
-    update_platforms_data()
+    def data_path(fname):
+        return os.path.join(data_dir, fname)
+
+    # all updates are independent of each other and mostly wait for the network,
+    # so we run them in parallel. requests.Session is not guaranteed to be thread-safe,
+    # so every updater gets a session of its own.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(update_tld_list, _make_session(), IANA_TLD_LIST_URL,
+                                   data_path('iana-filtered-tld-list.txt'),
+                                   force=options.force),
+                   executor.submit(update_spdx_id_list, _make_session(), SPDX_REPO_URL,
+                                   data_path('spdx-license-ids.txt'),
+                                   data_path('spdx-free-license-ids.txt'),
+                                   data_path('spdx-license-exception-ids.txt'),
+                                   force=options.force),
+                   executor.submit(update_categories_list, _make_session(), MENU_SPEC_URL,
+                                   data_path('xdg-category-names.txt'),
+                                   force=options.force),
+                   executor.submit(update_platforms_data, data_dir)]
+        for future in as_completed(futures):
+            # raise any exception that occurred in the worker
+            future.result()
 
     print('All done.')
 
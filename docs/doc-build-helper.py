@@ -34,20 +34,29 @@ EXTRA_CSS = [['/usr/share/javascript/highlight.js/styles/routeros.css',
               'highlight.css']]
 
 
-def daps_build(src_dir, project_name, daps_exe):
+def reset_build_dir(build_dir):
+    # the build directory is removed after every run, so this only has
+    # work to do if a previous run was aborted
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir, exist_ok=True)
+
+
+def daps_build(src_dir, project_name, daps_exe, reuse_build_dir=False):
     print('Creating HTML with DAPS...')
     sys.stdout.flush()
 
+    # we start from an empty build directory, or from one that only holds what
+    # "daps validate" produced (no HTML output), so there is no need to have
+    # DAPS clean it again
     build_dir = os.path.join(src_dir, '_docbuild')
     cmd = [daps_exe,
-           'html',
-           '--clean']
+           'html']
     if project_name:
         cmd.extend(['--name', project_name])
 
-    if os.path.exists(build_dir):
-        shutil.rmtree(build_dir)
-    os.makedirs(build_dir, exist_ok=True)
+    if not reuse_build_dir:
+        reset_build_dir(build_dir)
 
     ret = subprocess.call(cmd, cwd=src_dir)
     if ret != 0:
@@ -69,13 +78,16 @@ def daps_build(src_dir, project_name, daps_exe):
     return build_dir
 
 
-def copy_result(build_dir, project_name, dest_dir):
-    print('Copying HTML documentation...')
+def move_result(build_dir, project_name, dest_dir):
+    print('Moving HTML documentation into place...')
+
     if os.path.exists(dest_dir):
         shutil.rmtree(dest_dir)
 
-    shutil.copytree(os.path.join(build_dir, project_name, 'html', project_name),
-                    dest_dir, symlinks=True)
+    # the build directory is removed afterwards anyway, so we can just move
+    # the result instead of copying every file
+    shutil.move(os.path.join(build_dir, project_name, 'html', project_name),
+                dest_dir)
 
 
 def cleanup_build_dir(build_dir):
@@ -84,18 +96,17 @@ def cleanup_build_dir(build_dir):
         shutil.rmtree(build_dir)
 
 
-def daps_validate(src_dir, daps_exe):
+def daps_validate(src_dir, daps_exe, keep_build_dir=False):
     print('Validating documentation with DAPS...')
 
     build_dir = os.path.join(src_dir, '_docbuild')
-    if os.path.exists(build_dir):
-        shutil.rmtree(build_dir)
-    os.makedirs(build_dir, exist_ok=True)
+    reset_build_dir(build_dir)
 
     ret = subprocess.call([daps_exe, 'validate'], cwd=src_dir)
     if ret != 0:
         print('Validation failed!')
-    cleanup_build_dir(build_dir)
+    if ret != 0 or not keep_build_dir:
+        cleanup_build_dir(build_dir)
     return ret == 0
 
 
@@ -121,12 +132,19 @@ def main(args):
 
     os.chdir(options.src)
 
+    if options.validate:
+        # validate the XML, keeping the profiled sources for the HTML build if we make one
+        ret = daps_validate(options.src, options.daps, keep_build_dir=options.build)
+        if not ret:
+            sys.exit(6)
+
     if options.build:
         # build the HTML files
-        build_dir = daps_build(options.src, options.project, options.daps)
+        build_dir = daps_build(options.src, options.project, options.daps,
+                               reuse_build_dir=options.validate)
 
-        # copy to output HTML folder, overriding all previous contents
-        copy_result(build_dir, options.project,
+        # move to output HTML folder, replacing all previous contents
+        move_result(build_dir, options.project,
                     os.path.join(options.src, 'html'))
 
         # remove temporary directory
@@ -138,12 +156,6 @@ def main(args):
 
         print('Documentation built.')
 
-    elif options.validate:
-        # validate the XML
-        ret = daps_validate(options.src, options.daps)
-        if not ret:
-            sys.exit(6)
-
     return 0
 
 